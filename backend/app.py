@@ -2,16 +2,24 @@
 """
 Fail2ban Dashboard - Flask Application
 """
+import ipaddress
 import os
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, abort
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 
+from columnar import encode_columns
 from fail2ban_service import Fail2banService
 from geoip_service import GeoIPService
+from helper_client import HelperClient
+from ip_index import IPV4_PREFIXES, IPIndex
 from log_parser import LogParser
+from profiling import (SlowRequestLog, finish_trace, format_report, span,
+                       start_profiler, start_trace, stop_profiler)
+from resilience import BackendUnavailable, Deadline, StaleCache, breaker_states
 
 load_dotenv()
 
@@ -20,15 +28,47 @@ app = Flask(__name__,
             static_folder='../frontend')
 app.secret_key = os.environ.get('SECRET_KEY', 'change-this-secret-key-in-production')
 
+class TracedJSONProvider(DefaultJSONProvider):
+    """JSON provider that records serialization time in the request trace"""
+
+    def dumps(self, obj, **kwargs):
+        with span('json serialization'):
+            return super().dumps(obj, **kwargs)
+
+app.json = TracedJSONProvider(app)
+
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Optional privileged helper (see privileged_helper.py); without it the
+# services fall back to running sudo for each read
+HELPER_SOCKET = os.environ.get('PRIVILEGED_HELPER_SOCKET')
+helper = HelperClient(HELPER_SOCKET) if HELPER_SOCKET else None
+
 # Services
-fail2ban_service = Fail2banService()
+fail2ban_service = Fail2banService(helper=helper)
 geoip_service = GeoIPService()
-log_parser = LogParser()
+log_parser = LogParser(helper=helper)
+
+# Banned IPs that get country info, and failed IPs returned, by default
+TOP_BANNED_WITH_COUNTRY = 30
+TOP_FAILED = 50
+
+# Time budget for one API request, shared across its backend calls (seconds)
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '20'))
+
+# Last good data per section, served while a backend is unhealthy
+stale_cache = StaleCache()
+
+# Cross-jail IP index, updated whenever fresh jail data is fetched
+ip_index = IPIndex()
+
+# Requests slower than this (seconds) are kept in the slow-request log
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', '2'))
+slow_requests = SlowRequestLog(SLOW_REQUEST_THRESHOLD,
+                               int(os.environ.get('SLOW_REQUEST_LOG_SIZE', '100')))
 
 # Simple user model (in production, use a database)
 class User(UserMixin):
@@ -48,6 +88,20 @@ users = {
 def load_user(user_id):
     return users.get(user_id)
 
+def is_admin():
+    """Whether the current user is the admin user"""
+    return current_user.is_authenticated and current_user.username == ADMIN_USERNAME
+
+def admin_required(f):
+    """Restrict a view to the admin user"""
+    @wraps(f)
+    @login_required
+    def decorated(*args, **kwargs):
+        if not is_admin():
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated
+
 # Jail color mapping
 JAIL_COLORS = {
     'sshd': {'bg': 'bg-blue-500', 'border': 'border-blue-600', 'text': 'text-blue-600'},
@@ -67,6 +121,67 @@ def get_jail_color(jail_name):
             return JAIL_COLORS[key]
     return JAIL_COLORS['default']
 
+def fetch_section(sections, name, key, fn, *args, **kwargs):
+    """Run one backend call, falling back to its last good result
+
+    Records the outcome in sections[name]: 'ok', 'stale' (served from the
+    last good result) or 'missing' (nothing to serve, returns None).
+    """
+    try:
+        value = fn(*args, **kwargs)
+    except BackendUnavailable:
+        cached = stale_cache.get(key)
+        if cached is None:
+            sections[name] = 'missing'
+            return None
+        sections[name] = 'stale'
+        return cached[0]
+
+    if value is not None:
+        stale_cache.put(key, value)
+    sections[name] = 'ok'
+    return value
+
+def is_partial(sections):
+    """Whether any section of a response is stale or missing"""
+    return any(state != 'ok' for state in sections.values())
+
+# Request tracing and on-demand profiling
+@app.before_request
+def begin_trace():
+    """Trace every request; profile it too if an admin asks with ?profile=1"""
+    g.trace_token = start_trace(f'{request.method} {request.full_path.rstrip("?")}')
+    g.profiler = None
+    if request.args.get('profile') == '1' and is_admin():
+        g.profiler = start_profiler()
+        if g.profiler is None:
+            return jsonify({'success': False, 'error': 'Another request is being profiled'}), 409
+
+@app.after_request
+def end_trace(response):
+    """Log slow requests; replace the response with a report when profiling"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stop_profiler(profiler)
+
+    token = g.pop('trace_token', None)
+    if token is None:
+        return response
+    trace = finish_trace(token)
+    slow_requests.record(trace, response.status_code)
+
+    if profiler is not None:
+        return app.response_class(format_report(trace, profiler),
+                                  status=response.status_code, mimetype='text/plain')
+    return response
+
+@app.teardown_request
+def release_profiler(exc):
+    """Stop the profiler if the request failed before after_request ran"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stop_profiler(profiler)
+
 # Routes
 @app.route('/')
 @login_required
@@ -114,45 +229,118 @@ def detail(jail_name):
 def api_jails():
     """Get list of all jails with their status"""
     try:
-        jails = fail2ban_service.get_all_jails()
-        result = []
+        deadline = Deadline(REQUEST_DEADLINE)
+        sections = {}
+        jails = fetch_section(sections, 'jails', ('jails',),
+                              fail2ban_service.get_all_jails, deadline.split(2))
+        if jails is None:
+            return jsonify({'success': False, 'error': 'fail2ban is unavailable'}), 503
 
-        for jail_name in jails:
-            status = fail2ban_service.get_jail_status(jail_name)
+        result = []
+        for i, jail_name in enumerate(jails):
+            status = fetch_section(sections, jail_name, ('status', jail_name),
+                                   fail2ban_service.get_jail_status, jail_name,
+                                   deadline.split(len(jails) - i), include_banned=True)
             if status:
+                status = dict(status, stale=sections[jail_name] == 'stale')
+                banned_list = status.pop('banned_ip_list', None)
+                if sections[jail_name] == 'ok' and banned_list is not None:
+                    ip_index.update_jail(jail_name, 'banned', [{'ip': ip} for ip in banned_list])
                 status['color'] = get_jail_color(jail_name)
                 result.append(status)
 
-        return jsonify({'success': True, 'jails': result})
+        return jsonify({'success': True, 'jails': result,
+                        'sections': sections, 'partial': is_partial(sections)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/jail/<jail_name>')
 @login_required
 def api_jail_detail(jail_name):
-    """Get detailed status for a specific jail"""
+    """Get detailed status for a specific jail
+
+    Query parameters:
+      format=columnar  return the full IP lists as parallel arrays with
+                       country info stored once (see columnar.py); by
+                       default only the top banned/failed IPs are returned
+      delta=1          with format=columnar, delta-encode the counts
+    """
+    columnar = request.args.get('format') == 'columnar'
+    delta = request.args.get('delta') == '1'
+    failed_limit = None if columnar else TOP_FAILED
+
     try:
-        status = fail2ban_service.get_jail_status(jail_name)
+        # The budget is split across the remaining sections as each starts,
+        # so time one section does not use rolls over to the next
+        deadline = Deadline(REQUEST_DEADLINE)
+        sections = {}
+
+        status = fetch_section(sections, 'status', ('status', jail_name),
+                               fail2ban_service.get_jail_status, jail_name,
+                               deadline.split(5))
         if not status:
+            if sections['status'] == 'missing':
+                return jsonify({'success': False, 'error': 'fail2ban is unavailable'}), 503
             return jsonify({'success': False, 'error': 'Jail not found'}), 404
+        status = dict(status)
+        status.pop('banned_ip_list', None)
 
         # Get banned IPs with country info
-        banned_ips = fail2ban_service.get_banned_ips(jail_name)
+        banned_ips = fetch_section(sections, 'banned_ips', ('banned_ips', jail_name),
+                                   fail2ban_service.get_banned_ips, jail_name,
+                                   deadline.split(4), with_counts=False) or []
+
+        # Reject counts come from iptables, a separate backend: without them
+        # the ban list is still shown, with the last known counts or none
+        reject_counts = None
+        sections['reject_counts'] = 'ok'
+        if banned_ips:
+            reject_counts = fetch_section(sections, 'reject_counts', ('reject_counts', jail_name),
+                                          fail2ban_service.get_reject_counts, jail_name,
+                                          deadline.split(3))
+        banned_ips = fail2ban_service.add_reject_counts(banned_ips, reject_counts)
         ips_with_country = []
 
-        for ip_info in banned_ips[:30]:  # Top 30
-            country = geoip_service.get_country(ip_info['ip'])
-            ip_info['country'] = country
-            ips_with_country.append(ip_info)
+        geoip_deadline = deadline.split(2)
+        sections['countries'] = 'ok'
+        for ip_info in banned_ips[:TOP_BANNED_WITH_COUNTRY]:
+            try:
+                country = geoip_service.get_country(ip_info['ip'], geoip_deadline)
+            except BackendUnavailable:
+                country = None
+                sections['countries'] = 'missing'
+            ips_with_country.append(dict(ip_info, country=country))
 
         # Get failed IPs
-        failed_ips = fail2ban_service.get_failed_ips(jail_name)
-
-        status['banned_ips'] = ips_with_country
-        status['failed_ips'] = failed_ips
+        failed_ips = fetch_section(sections, 'failed_ips', ('failed_ips', jail_name, failed_limit),
+                                   fail2ban_service.get_failed_ips, jail_name,
+                                   deadline.split(1), limit=failed_limit) or []
+
+        if sections['banned_ips'] == 'ok':
+            ip_index.update_jail(jail_name, 'banned', banned_ips)
+        if sections['failed_ips'] == 'ok':
+            ip_index.update_jail(jail_name, 'failed', failed_ips)
+
+        if columnar:
+            # Every banned IP is returned; only the top ones have a country
+            rows = ips_with_country + banned_ips[TOP_BANNED_WITH_COUNTRY:]
+            status['banned_ips'] = encode_columns(
+                rows, ['ip', 'reject_count', 'country'],
+                dictionary=['country'],
+                # Unknown counts stay null rather than being delta-encoded as 0
+                delta=['reject_count'] if delta and reject_counts is not None else []
+            )
+            status['failed_ips'] = encode_columns(
+                failed_ips, ['ip', 'fail_count'],
+                delta=['fail_count'] if delta else []
+            )
+        else:
+            status['banned_ips'] = ips_with_country
+            status['failed_ips'] = failed_ips
         status['color'] = get_jail_color(jail_name)
 
-        return jsonify({'success': True, 'jail': status})
+        return jsonify({'success': True, 'jail': status,
+                        'sections': sections, 'partial': is_partial(sections)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -161,8 +349,14 @@ def api_jail_detail(jail_name):
 def api_jail_histogram(jail_name):
     """Get histogram data for reject counts"""
     try:
-        histogram = fail2ban_service.get_reject_histogram(jail_name)
-        return jsonify({'success': True, 'histogram': histogram})
+        sections = {}
+        histogram = fetch_section(sections, 'histogram', ('histogram', jail_name),
+                                  fail2ban_service.get_reject_histogram, jail_name,
+                                  Deadline(REQUEST_DEADLINE))
+        if histogram is None:
+            return jsonify({'success': False, 'error': 'Backend is unavailable'}), 503
+        return jsonify({'success': True, 'histogram': histogram,
+                        'stale': sections['histogram'] == 'stale'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -179,6 +373,8 @@ def api_ban_ip(jail_name):
 
         result = fail2ban_service.ban_ip(jail_name, ip)
         return jsonify({'success': result})
+    except BackendUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -195,6 +391,8 @@ def api_unban_ip(jail_name):
 
         result = fail2ban_service.unban_ip(jail_name, ip)
         return jsonify({'success': result})
+    except BackendUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -203,10 +401,71 @@ def api_unban_ip(jail_name):
 def api_logs(jail_name):
     """Get parsed log entries for a jail"""
     try:
-        logs = log_parser.parse_logs(jail_name)
-        return jsonify({'success': True, 'logs': logs})
+        sections = {}
+        logs = fetch_section(sections, 'logs', ('logs', jail_name),
+                             log_parser.parse_logs, jail_name,
+                             deadline=Deadline(REQUEST_DEADLINE))
+        if logs is None:
+            return jsonify({'success': False, 'error': 'Log file is unavailable'}), 503
+        if sections['logs'] == 'ok':
+            ip_index.update_jail(jail_name, 'logs', logs)
+        return jsonify({'success': True, 'logs': logs,
+                        'stale': sections['logs'] == 'stale'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/ip/<path:addr>')
+@login_required
+def api_ip_lookup(addr):
+    """Look up an IP, or the IPs in a /24 or /16 network, across all jails
+
+    Answers from the IP index only; it covers the jail data the dashboard
+    has fetched (ban lists on every dashboard refresh, reject/fail counts
+    from detail pages, log hits from log requests).
+    """
+    try:
+        network = ipaddress.ip_network(addr, strict=False)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid IP address or network'}), 400
+
+    if network.num_addresses == 1:
+        ip = str(network.network_address)
+        record = ip_index.lookup(ip)
+        return jsonify({'success': True, 'ip': ip, 'found': record is not None, 'record': record})
+
+    if network.version != 4 or network.prefixlen not in IPV4_PREFIXES:
+        return jsonify({'success': False, 'error': 'Only /24 and /16 networks can be searched'}), 400
+
+    records, total = ip_index.lookup_prefix(str(network))
+    return jsonify({'success': True, 'prefix': str(network), 'total': total, 'ips': records})
+
+@app.route('/api/ips/multi-service')
+@login_required
+def api_multi_service_ips():
+    """Get IPs that are banned, failing or logged in more than one jail"""
+    records, total = ip_index.multi_service()
+    return jsonify({'success': True, 'total': total, 'ips': records})
+
+@app.route('/admin/slow-requests')
+@admin_required
+def admin_slow_requests():
+    """Slow request log page"""
+    return render_template('slow_requests.html',
+                           entries=slow_requests.entries(),
+                           threshold=SLOW_REQUEST_THRESHOLD)
+
+@app.route('/api/admin/slow-requests')
+@admin_required
+def api_slow_requests():
+    """Get the slow request log, newest first"""
+    return jsonify({'success': True, 'threshold': SLOW_REQUEST_THRESHOLD,
+                    'requests': slow_requests.entries()})
+
+@app.route('/api/backends')
+@login_required
+def api_backends():
+    """Get circuit breaker state for each backend"""
+    return jsonify({'success': True, 'backends': breaker_states()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Columnar - Compact JSON encoding for long per-IP lists
+Turns a list of row dicts into parallel arrays so keys are not repeated
+for every row. Repeated dict values (like country info) are stored once
+in a dictionary and referenced by index.
+"""
+
+
+def encode_columns(rows, columns, dictionary=(), delta=()):
+    """Encode a list of row dicts as parallel column arrays
+
+    columns:    keys to emit, in order
+    dictionary: columns whose values are stored once in
+                'dictionaries' and referenced by index (-1 for None)
+    delta:      integer columns stored as the first value followed by
+                differences between neighbours
+
+    Example:
+        encode_columns([{'ip': 'a', 'n': 5}, {'ip': 'b', 'n': 3}],
+                       ['ip', 'n'], delta=['n'])
+        -> {'format': 'columnar', 'length': 2,
+            'columns': {'ip': ['a', 'b'], 'n': [5, -2]},
+            'dictionaries': {}, 'delta': ['n']}
+    """
+    encoded = {column: [] for column in columns}
+    dictionaries = {column: [] for column in dictionary}
+    lookups = {column: {} for column in dictionary}
+
+    for row in rows:
+        for column in columns:
+            value = row.get(column)
+            if column in lookups:
+                value = _dictionary_index(value, dictionaries[column], lookups[column])
+            encoded[column].append(value)
+
+    for column in delta:
+        encoded[column] = _delta_encode(encoded[column])
+
+    return {
+        'format': 'columnar',
+        'length': len(rows),
+        'columns': encoded,
+        'dictionaries': dictionaries,
+        'delta': list(delta)
+    }
+
+
+def _dictionary_index(value, values, lookup):
+    """Index of value in the column dictionary, adding it if new"""
+    if value is None:
+        return -1
+    key = tuple(sorted(value.items())) if isinstance(value, dict) else value
+    if key not in lookup:
+        lookup[key] = len(values)
+        values.append(value)
+    return lookup[key]
+
+
+def _delta_encode(values):
+    """[a, b, c] -> [a, b - a, c - b]"""
+    encoded = []
+    previous = 0
+    for value in values:
+        value = value or 0
+        encoded.append(value - previous)
+        previous = value
+    return encoded
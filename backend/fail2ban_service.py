@@ -2,36 +2,85 @@
 """
 Fail2ban Service - Interface with fail2ban-client
 """
-import subprocess
 import re
+import threading
 from collections import defaultdict
 
+from profiling import span
+from resilience import (COMMAND_TIMEOUT, BackendUnavailable, DeadlineExceeded,
+                        get_breaker, run_backend_command)
+
+FAIL2BAN_LOG = '/var/log/fail2ban.log'
+
+# Bytes of the fail2ban log fetched from the helper per read
+LOG_READ_CHUNK = 4 * 1024 * 1024
+
+# e.g. "fail2ban.filter [812]: INFO [sshd] Found 203.0.113.7 - 2024-01-01 ..."
+FOUND_PATTERN = re.compile(r'\[([^\]]+)\]\s+Found\s+(\d+\.\d+\.\d+\.\d+)')
+
+# fail2ban-client output when the server is not running or unreachable
+SERVER_DOWN_MESSAGES = (
+    'Failed to access socket path',
+    'Is fail2ban running?',
+    'Unable to contact server',
+)
+
+
+class _LogScan:
+    """How far the fail2ban log has been read, and the failures found so far"""
+
+    def __init__(self, inode):
+        self.inode = inode
+        self.offset = 0
+        # jail -> ip -> number of "Found" lines
+        self.failures = defaultdict(lambda: defaultdict(int))
+
+
+def check_server_reachable(result):
+    """Error message if fail2ban-client could not talk to the server
+
+    Other non-zero exits (e.g. an unknown jail) are real answers and are
+    left to the caller.
+    """
+    if result.returncode == 0:
+        return None
+    output = (result.stderr or '') + (result.stdout or '')
+    if any(message in output for message in SERVER_DOWN_MESSAGES):
+        return 'fail2ban server is not reachable'
+    return None
+
 
 class Fail2banService:
     """Service class to interact with fail2ban-client"""
 
-    def __init__(self):
+    def __init__(self, helper=None):
         self.sudo_cmd = ['sudo', 'fail2ban-client']
-
-    def _run_command(self, args):
-        """Run fail2ban-client command with sudo"""
-        try:
-            cmd = self.sudo_cmd + args
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=30
+        # Optional HelperClient; iptables and log reads fall back to sudo
+        self.helper = helper
+        self.breaker = get_breaker('fail2ban')
+        self.iptables_breaker = get_breaker('iptables')
+        self.log_breaker = get_breaker(f'log:{FAIL2BAN_LOG}')
+        self._log_scan = None
+        self._log_scan_lock = threading.Lock()
+
+    def _run_command(self, args, deadline=None, use_breaker=True):
+        """Run fail2ban-client command with sudo
+
+        Reads go through the fail2ban breaker. Writes (ban/unban) pass
+        use_breaker=False so an explicit action is always attempted.
+        """
+        cmd = self.sudo_cmd + args
+        if use_breaker:
+            output, returncode = self.breaker.call(
+                run_backend_command, cmd, deadline, check=check_server_reachable
             )
-            return result.stdout.strip(), result.returncode == 0
-        except subprocess.TimeoutExpired:
-            return '', False
-        except Exception as e:
-            return str(e), False
+        else:
+            output, returncode = run_backend_command(cmd, deadline, check=check_server_reachable)
+        return output.strip(), returncode == 0
 
-    def get_all_jails(self):
+    def get_all_jails(self, deadline=None):
         """Get list of all jail names"""
-        output, success = self._run_command(['status'])
+        output, success = self._run_command(['status'], deadline)
         if not success:
             return []
 
@@ -43,9 +92,13 @@ class Fail2banService:
             return jails
         return []
 
-    def get_jail_status(self, jail_name):
-        """Get status for a specific jail"""
-        output, success = self._run_command(['status', jail_name])
+    def get_jail_status(self, jail_name, deadline=None, include_banned=False):
+        """Get status for a specific jail
+
+        With include_banned, also return the banned IPs from the same
+        output as 'banned_ip_list' (no iptables reject counts).
+        """
+        output, success = self._run_command(['status', jail_name], deadline)
         if not success:
             return None
 
@@ -82,87 +135,107 @@ class Fail2banService:
                 if match:
                     status['total_banned'] = int(match.group(1))
 
+        if include_banned:
+            status['banned_ip_list'] = self._parse_banned_list(output)
+
         return status
 
-    def get_banned_ips(self, jail_name):
-        """Get list of currently banned IPs with reject counts"""
-        output, success = self._run_command(['status', jail_name])
-        if not success:
+    def _parse_banned_list(self, output):
+        """Get the IPs from the "Banned IP list:" line of a status output"""
+        match = re.search(r'Banned IP list:\s*(.+?)(?:\n|$)', output)
+        if not match:
             return []
+        return [ip.strip() for ip in match.group(1).split() if ip.strip()]
+
+    def get_banned_ips(self, jail_name, deadline=None, with_counts=True):
+        """Get list of currently banned IPs with reject counts
 
-        banned_ips = []
+        The counts come from iptables, a separate backend: if it cannot be
+        read the IPs are still returned, with reject_count None. With
+        with_counts=False iptables is not asked at all (for callers that
+        fetch the counts themselves, see get_reject_counts).
+        """
+        output, success = self._run_command(['status', jail_name], deadline)
+        if not success:
+            return []
 
         # Find banned IP list in output
-        match = re.search(r'Banned IP list:\s*(.+?)(?:\n|$)', output)
-        if match:
-            ips_str = match.group(1).strip()
-            if ips_str:
-                ips = [ip.strip() for ip in ips_str.split() if ip.strip()]
+        banned_ips = [{'ip': ip} for ip in self._parse_banned_list(output)]
 
-                # Get reject counts from iptables
-                reject_counts = self._get_reject_counts(jail_name)
+        reject_counts = None
+        if banned_ips and with_counts:
+            try:
+                reject_counts = self.get_reject_counts(jail_name, deadline)
+            except BackendUnavailable:
+                pass
 
-                for ip in ips:
-                    banned_ips.append({
-                        'ip': ip,
-                        'reject_count': reject_counts.get(ip, 0)
-                    })
+        return self.add_reject_counts(banned_ips, reject_counts)
 
-        # Sort by reject count (descending)
-        banned_ips.sort(key=lambda x: x['reject_count'], reverse=True)
-        return banned_ips
+    def add_reject_counts(self, banned_ips, reject_counts):
+        """Banned IP rows with reject_count set, sorted by it (descending)
 
-    def _get_reject_counts(self, jail_name):
-        """Get reject counts from iptables-save for banned IPs"""
-        counts = defaultdict(int)
+        reject_counts of None (iptables unavailable) sets every count to None.
+        """
+        if reject_counts is None:
+            return [dict(row, reject_count=None) for row in banned_ips]
 
-        try:
-            # Use iptables-save -c for reading (read-only, more secure)
-            result = subprocess.run(
-                ['sudo', 'iptables-save', '-c'],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
+        rows = [dict(row, reject_count=reject_counts.get(row['ip'], 0)) for row in banned_ips]
+        rows.sort(key=lambda x: x['reject_count'], reverse=True)
+        return rows
 
-            if result.returncode == 0:
-                chain_name = f'f2b-{jail_name}'
-                for line in result.stdout.split('\n'):
-                    # Match lines like: [708:36816] -A f2b-postfix-sasl -s 77.83.39.180/32 -j REJECT
-                    if chain_name in line and 'REJECT' in line:
-                        match = re.search(
-                            r'\[(\d+):\d+\]\s+-A\s+' + re.escape(chain_name) + r'\s+-s\s+(\d+\.\d+\.\d+\.\d+)/32',
-                            line
-                        )
-                        if match:
-                            count = int(match.group(1))
-                            ip = match.group(2)
-                            counts[ip] = count
-        except Exception:
-            pass
+    def get_reject_counts(self, jail_name, deadline=None):
+        """Get reject counts from iptables-save for banned IPs
+
+        Raises BackendUnavailable if iptables cannot be read.
+        """
+        output = self.iptables_breaker.call(self._read_iptables_counters, deadline)
+
+        counts = defaultdict(int)
+        chain_name = f'f2b-{jail_name}'
+        with span('regex iptables reject counts'):
+            for line in output.split('\n'):
+                # Match lines like: [708:36816] -A f2b-postfix-sasl -s 77.83.39.180/32 -j REJECT
+                if chain_name in line and 'REJECT' in line:
+                    match = re.search(
+                        r'\[(\d+):\d+\]\s+-A\s+' + re.escape(chain_name) + r'\s+-s\s+(\d+\.\d+\.\d+\.\d+)/32',
+                        line
+                    )
+                    if match:
+                        count = int(match.group(1))
+                        ip = match.group(2)
+                        counts[ip] = count
 
         return dict(counts)
 
-    def get_failed_ips(self, jail_name):
-        """Get list of IPs currently being counted for failures"""
+    def _read_iptables_counters(self, deadline=None):
+        """iptables-save -c output; a failed run raises BackendUnavailable"""
+        # Use iptables-save -c for reading (read-only, more secure)
+        if self.helper:
+            output, returncode = self.helper.iptables_counters(deadline)
+        else:
+            output, returncode = run_backend_command(['sudo', 'iptables-save', '-c'], deadline)
+        if returncode != 0:
+            raise BackendUnavailable(f'iptables-save failed with exit code {returncode}')
+        return output
+
+    def get_failed_ips(self, jail_name, deadline=None, limit=50):
+        """Get list of IPs currently being counted for failures
+
+        Returns the top `limit` IPs by fail count, or all of them if limit is None.
+        """
         # Use fail2ban-client to get failed IPs
         # Note: This requires fail2ban 0.10+ with the 'get' command
-        output, success = self._run_command(['get', jail_name, 'failregex'])
+        output, success = self._run_command(['get', jail_name, 'failregex'], deadline)
 
         # Alternative: parse the fail2ban log
         failed_ips = []
 
         try:
-            result = subprocess.run(
-                ['sudo', 'fail2ban-client', 'status', jail_name],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
+            _, success = self._run_command(['status', jail_name], deadline)
 
-            if result.returncode == 0:
+            if success:
                 # Get filter info
-                filter_output, _ = self._run_command(['get', jail_name, 'findtime'])
+                filter_output, _ = self._run_command(['get', jail_name, 'findtime'], deadline)
                 findtime = 600  # default
 
                 try:
@@ -171,21 +244,11 @@ class Fail2banService:
                     pass
 
                 # Parse fail2ban log for recent failures
-                log_result = subprocess.run(
-                    ['sudo', 'grep', f'\\[{jail_name}\\]', '/var/log/fail2ban.log'],
-                    capture_output=True,
-                    text=True,
-                    timeout=30
+                ip_failures = self.log_breaker.call(
+                    self._count_log_failures, jail_name, deadline
                 )
 
-                if log_result.returncode == 0:
-                    ip_failures = defaultdict(int)
-                    for line in log_result.stdout.split('\n'):
-                        if 'Found' in line:
-                            match = re.search(r'Found\s+(\d+\.\d+\.\d+\.\d+)', line)
-                            if match:
-                                ip_failures[match.group(1)] += 1
-
+                if ip_failures is not None:
                     for ip, count in ip_failures.items():
                         failed_ips.append({
                             'ip': ip,
@@ -194,18 +257,100 @@ class Fail2banService:
 
                     failed_ips.sort(key=lambda x: x['fail_count'], reverse=True)
 
+        except BackendUnavailable:
+            raise
         except Exception:
             pass
 
-        return failed_ips[:50]  # Return top 50
+        return failed_ips[:limit]
+
+    def _count_log_failures(self, jail_name, deadline=None):
+        """{ip: fail count} for a jail from the fail2ban log, or None if unreadable"""
+        if self.helper:
+            return self._scan_fail2ban_log(jail_name, deadline)
+
+        output, returncode = run_backend_command(
+            ['sudo', 'grep', '-F', f'[{jail_name}]', FAIL2BAN_LOG], deadline
+        )
+        if returncode != 0:
+            return None
+
+        ip_failures = defaultdict(int)
+        with span('regex fail2ban log failures'):
+            for line in output.split('\n'):
+                if 'Found' in line:
+                    match = re.search(r'Found\s+(\d+\.\d+\.\d+\.\d+)', line)
+                    if match:
+                        ip_failures[match.group(1)] += 1
+        return dict(ip_failures)
+
+    def _scan_fail2ban_log(self, jail_name, deadline=None):
+        """Failure counts from the fail2ban log, reading only what was appended
+
+        The helper keeps our place in the log by inode and byte offset, and
+        counts for every jail are kept between calls. A new inode or a file
+        smaller than our offset means the log was rotated, so the counts
+        start over. The offset is committed after each chunk, so a scan cut
+        short by the deadline picks up where it stopped.
+        """
+        timeout = deadline.timeout(COMMAND_TIMEOUT) if deadline else -1
+        if not self._log_scan_lock.acquire(timeout=timeout):
+            raise DeadlineExceeded('Ran out of request time waiting for the fail2ban log scan')
+        try:
+            info = self.helper.stat(FAIL2BAN_LOG, deadline=deadline)
+            if not info.get('exists'):
+                self._log_scan = None
+                return None
+
+            scan = self._log_scan
+            if scan is None or scan.inode != info['inode'] or info['size'] < scan.offset:
+                scan = self._log_scan = _LogScan(info['inode'])
+
+            with span(f'helper scan {FAIL2BAN_LOG}'):
+                while scan.offset < info['size']:
+                    header, data = self.helper.read_log(
+                        FAIL2BAN_LOG, scan.offset, LOG_READ_CHUNK, deadline
+                    )
+                    if header['offset'] != scan.offset:
+                        # Truncated since the stat: the helper restarted at 0
+                        scan = self._log_scan = _LogScan(info['inode'])
+                    if not data:
+                        break
+
+                    # Only count whole lines; a partial last line is read again next time
+                    end = data.rfind(b'\n') + 1
+                    if not end:
+                        if len(data) < LOG_READ_CHUNK:
+                            break
+                        end = len(data)
+
+                    for line in data[:end].decode('utf-8', errors='replace').split('\n'):
+                        if 'Found' in line:
+                            match = FOUND_PATTERN.search(line)
+                            if match:
+                                scan.failures[match.group(1)][match.group(2)] += 1
+                    scan.offset += end
+
+            return dict(scan.failures.get(jail_name, {}))
+        except FileNotFoundError:
+            self._log_scan = None
+            return None
+        finally:
+            self._log_scan_lock.release()
+
+    def get_reject_histogram(self, jail_name, deadline=None):
+        """Get histogram data for reject counts
 
-    def get_reject_histogram(self, jail_name):
-        """Get histogram data for reject counts"""
-        banned_ips = self.get_banned_ips(jail_name)
+        Raises BackendUnavailable if iptables cannot be read, since the
+        histogram is nothing but reject counts.
+        """
+        banned_ips = self.get_banned_ips(jail_name, deadline, with_counts=False)
 
         if not banned_ips:
             return {'labels': [], 'data': []}
 
+        banned_ips = self.add_reject_counts(banned_ips, self.get_reject_counts(jail_name, deadline))
+
         # Create histogram buckets
         counts = [ip['reject_count'] for ip in banned_ips]
 
@@ -245,10 +390,10 @@ class Fail2banService:
 
     def ban_ip(self, jail_name, ip):
         """Ban an IP address in a jail"""
-        _, success = self._run_command(['set', jail_name, 'banip', ip])
+        _, success = self._run_command(['set', jail_name, 'banip', ip], use_breaker=False)
         return success
 
     def unban_ip(self, jail_name, ip):
         """Unban an IP address from a jail"""
-        _, success = self._run_command(['set', jail_name, 'unbanip', ip])
+        _, success = self._run_command(['set', jail_name, 'unbanip', ip], use_breaker=False)
         return success
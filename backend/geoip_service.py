@@ -3,36 +3,79 @@
 GeoIP Service - Get country information for IP addresses
 Uses ip-api.com free API
 """
+import threading
+from collections import OrderedDict
+
 import requests
-from functools import lru_cache
+
+from profiling import span
+from resilience import BackendUnavailable, DeadlineExceeded, get_breaker
 
 
 class GeoIPService:
     """Service class to get geographic information for IP addresses"""
 
+    CACHE_SIZE = 1000
+    REQUEST_TIMEOUT = 5
+
     def __init__(self):
         self.api_url = 'http://ip-api.com/json/'
-        self.cache = {}
+        self.cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.breaker = get_breaker('geoip')
+
+    def get_country(self, ip, deadline=None):
+        """Get country information for an IP address
+
+        Raises BackendUnavailable if ip-api.com cannot be reached in time.
+        Only real answers are cached, so a timeout is retried next time.
+        """
+        # Skip private/local IPs
+        if self._is_private_ip(ip):
+            return {
+                'country': 'Private',
+                'country_code': 'XX',
+                'city': 'Local Network',
+                'isp': 'Local'
+            }
+
+        with self._cache_lock:
+            if ip in self.cache:
+                self.cache.move_to_end(ip)
+                return self.cache[ip]
+
+        country = self.breaker.call(self._query, ip, deadline)
+
+        with self._cache_lock:
+            self.cache[ip] = country
+            if len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return country
 
-    @lru_cache(maxsize=1000)
-    def get_country(self, ip):
-        """Get country information for an IP address"""
+    def _query(self, ip, deadline=None):
+        """Look an IP up on ip-api.com"""
+        timeout = deadline.timeout(self.REQUEST_TIMEOUT) if deadline else self.REQUEST_TIMEOUT
         try:
-            # Skip private/local IPs
-            if self._is_private_ip(ip):
-                return {
-                    'country': 'Private',
-                    'country_code': 'XX',
-                    'city': 'Local Network',
-                    'isp': 'Local'
-                }
-
-            response = requests.get(
-                f'{self.api_url}{ip}',
-                params={'fields': 'status,country,countryCode,city,isp'},
-                timeout=5
-            )
+            with span(f'geoip {ip}'):
+                response = requests.get(
+                    f'{self.api_url}{ip}',
+                    params={'fields': 'status,country,countryCode,city,isp'},
+                    timeout=timeout
+                )
+        except requests.exceptions.Timeout:
+            # Many lookups share one slice of the request budget, so only a
+            # lookup that had its full timeout says anything about ip-api.com
+            if timeout < self.REQUEST_TIMEOUT:
+                raise DeadlineExceeded(f'GeoIP lookup ran out of request time after {timeout:.1f}s')
+            raise BackendUnavailable(f'GeoIP lookup timed out after {timeout:.1f}s')
+        except requests.exceptions.RequestException as e:
+            raise BackendUnavailable(f'GeoIP lookup failed: {e}')
+
+        # Rate limited or server error: try again later rather than cache
+        if response.status_code == 429 or response.status_code >= 500:
+            raise BackendUnavailable(f'GeoIP lookup failed: HTTP {response.status_code}')
 
+        try:
             if response.status_code == 200:
                 data = response.json()
                 if data.get('status') == 'success':
@@ -50,13 +93,6 @@ class GeoIPService:
                 'isp': ''
             }
 
-        except requests.exceptions.Timeout:
-            return {
-                'country': 'Timeout',
-                'country_code': 'XX',
-                'city': '',
-                'isp': ''
-            }
         except Exception:
             return {
                 'country': 'Error',
@@ -90,9 +126,15 @@ class GeoIPService:
         except Exception:
             return False
 
-    def get_country_batch(self, ips):
-        """Get country information for multiple IPs"""
+    def get_country_batch(self, ips, deadline=None):
+        """Get country information for multiple IPs
+
+        IPs whose lookup fails are left out of the result.
+        """
         results = {}
         for ip in ips:
-            results[ip] = self.get_country(ip)
+            try:
+                results[ip] = self.get_country(ip, deadline)
+            except BackendUnavailable:
+                continue
         return results
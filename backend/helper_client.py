@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Helper Client - Pooled connections to the privileged helper
+See privileged_helper.py for the socket protocol.
+"""
+import errno
+import json
+import queue
+import socket
+import struct
+
+from profiling import span
+from resilience import BackendUnavailable, timeout_error
+
+MAX_HEADER = 4096
+
+
+class _Connection:
+    """One helper socket and its buffered reader"""
+
+    def __init__(self, socket_path, timeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class HelperClient:
+    """Client for the privileged helper, reusing a small pool of connections"""
+
+    REQUEST_TIMEOUT = 30
+
+    def __init__(self, socket_path, pool_size=4):
+        self.socket_path = socket_path
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _checkout(self, timeout, fresh=False):
+        if not fresh:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                conn.sock.settimeout(timeout)
+                return conn, True
+        return _Connection(self.socket_path, timeout), False
+
+    def _checkin(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _clear_pool(self):
+        """Close every pooled connection, e.g. after the helper restarted"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _send(self, op, deadline, params):
+        """Send a request and read the response header
+
+        A pooled connection may have been closed by a helper restart, so a
+        reset or EOF on one empties the pool (the other pooled connections
+        died with it) and is retried once on a new connection. Timeouts
+        are not retried, and the timeout is recomputed from the deadline
+        before each attempt.
+        """
+        message = json.dumps(dict(params, op=op)).encode() + b'\n'
+
+        for attempt in range(2):
+            timeout = self._timeout(deadline)
+            conn = None
+            pooled = False
+            try:
+                conn, pooled = self._checkout(timeout, fresh=attempt > 0)
+                conn.sock.sendall(message)
+                line = conn.rfile.readline(MAX_HEADER)
+                if not line:
+                    raise ConnectionResetError('Helper closed the connection')
+                return conn, json.loads(line)
+            except socket.timeout:
+                if conn:
+                    conn.close()
+                raise self._timeout_error(timeout)
+            except (ConnectionResetError, BrokenPipeError) as e:
+                if conn:
+                    conn.close()
+                if not pooled or attempt:
+                    raise BackendUnavailable(f'Privileged helper unavailable: {e}')
+                self._clear_pool()
+            except (OSError, ValueError) as e:
+                if conn:
+                    conn.close()
+                raise BackendUnavailable(f'Privileged helper unavailable: {e}')
+
+    def _timeout(self, deadline):
+        """Socket timeout for the next step; raises DeadlineExceeded when out of time"""
+        return deadline.timeout(self.REQUEST_TIMEOUT) if deadline else self.REQUEST_TIMEOUT
+
+    def _timeout_error(self, timeout):
+        """Error for a socket timeout (see resilience.timeout_error)"""
+        return timeout_error('Privileged helper', timeout, self.REQUEST_TIMEOUT)
+
+    def _request(self, op, deadline=None, **params):
+        """Run one operation; return (header, iterator over body chunks)
+
+        The connection goes back to the pool once the body has been read
+        to the end, and is closed if the caller stops early or the deadline
+        runs out part way through.
+        """
+        conn, header = self._send(op, deadline, params)
+
+        if not header.get('ok'):
+            self._checkin(conn)
+            if header.get('errno') == errno.ENOENT:
+                raise FileNotFoundError(header.get('error'))
+            raise BackendUnavailable(f"Privileged helper error: {header.get('error')}")
+
+        def body():
+            # The whole body shares the request deadline: the socket timeout
+            # is reset from what is left before every frame
+            done = False
+            timeout = None
+            try:
+                while True:
+                    timeout = self._timeout(deadline)
+                    conn.sock.settimeout(timeout)
+                    size = struct.unpack('>I', self._read_exact(conn, 4))[0]
+                    if size == 0:
+                        done = True
+                        return
+                    yield self._read_exact(conn, size)
+            except socket.timeout:
+                raise self._timeout_error(timeout)
+            except OSError as e:
+                raise BackendUnavailable(f'Privileged helper read failed: {e}')
+            finally:
+                if done:
+                    self._checkin(conn)
+                else:
+                    conn.close()
+
+        return header, body()
+
+    def _read_exact(self, conn, size):
+        data = conn.rfile.read(size)
+        if len(data) != size:
+            raise ConnectionResetError('Helper closed the connection')
+        return data
+
+    def stat(self, path, deadline=None):
+        """Stat a log file: {'exists': bool, 'size', 'mtime', 'inode'}"""
+        with span(f'helper stat {path}'):
+            header, body = self._request('stat', deadline, path=path)
+            for _ in body:
+                pass
+        return header
+
+    def read_log(self, path, offset=0, length=None, deadline=None):
+        """Read up to length bytes of a log file from an offset; return (header, bytes)
+
+        header['offset'] is where the read actually started: 0 if the file
+        was truncated or rotated below the requested offset.
+        """
+        params = {'path': path, 'offset': offset}
+        if length is not None:
+            params['length'] = length
+        with span(f'helper read_log {path}'):
+            header, body = self._request('read_log', deadline, **params)
+            return header, b''.join(body)
+
+    def tail_log(self, path, lines, deadline=None):
+        """Return the last lines of a log file as text"""
+        with span(f'helper tail_log {path}'):
+            _, body = self._request('tail_log', deadline, path=path, lines=lines)
+            return b''.join(body).decode('utf-8', errors='replace')
+
+    def iptables_counters(self, deadline=None):
+        """Return (iptables-save -c output, returncode)"""
+        with span('helper iptables_counters'):
+            header, body = self._request('iptables_counters', deadline)
+            return b''.join(body).decode('utf-8', errors='replace'), header.get('returncode', 1)
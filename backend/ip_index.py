@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+IP Index - Cross-jail inverted index of IP addresses
+Maps each IP (and its /24 and /16 prefix) to the jails it is banned or
+failing in, so "where is this IP" is a dict lookup instead of a full
+status/iptables/log pass over every jail.
+"""
+import ipaddress
+import threading
+import time
+
+# Fields each kind of jail data fills in, and their empty values
+KIND_FIELDS = {
+    'banned': {'banned': False, 'reject_count': None},
+    'failed': {'fail_count': None},
+    'logs': {'log_hits': None, 'last_seen': None},
+}
+
+IPV4_PREFIXES = (24, 16)
+
+
+def ip_prefixes(ip):
+    """The /24 and /16 networks an IPv4 address belongs to"""
+    try:
+        addr = ipaddress.IPv4Address(ip)
+    except ValueError:
+        return []
+    return [str(ipaddress.IPv4Network(f'{addr}/{bits}', strict=False)) for bits in IPV4_PREFIXES]
+
+
+class IPIndex:
+    """Inverted index from IP address to per-jail activity"""
+
+    def __init__(self):
+        self._ips = {}          # ip -> {jail: entry}
+        self._jail_ips = {}     # (jail, kind) -> set of ips
+        self._prefixes = {}     # prefix -> set of ips
+        self._multi_service = set()
+        self._lock = threading.Lock()
+
+    def update_jail(self, jail_name, kind, rows):
+        """Replace what the index knows about one kind of data for a jail
+
+        kind is 'banned' (rows with 'ip' and optionally 'reject_count'),
+        'failed' (rows with 'ip', 'fail_count') or 'logs' (rows from
+        LogParser.parse_logs). IPs missing from rows are dropped for
+        that kind.
+        """
+        now = time.time()
+        with self._lock:
+            new_ips = set()
+            for row in rows:
+                ip = row['ip']
+                new_ips.add(ip)
+                entry = self._entry(ip, jail_name)
+                if kind == 'banned':
+                    entry['banned'] = True
+                    if row.get('reject_count') is not None:
+                        entry['reject_count'] = row['reject_count']
+                elif kind == 'failed':
+                    entry['fail_count'] = row.get('fail_count')
+                elif kind == 'logs':
+                    entry['log_hits'] = row.get('count')
+                    entry['last_seen'] = row.get('last_seen')
+                entry['updated'] = now
+
+            old_ips = self._jail_ips.get((jail_name, kind), set())
+            for ip in old_ips - new_ips:
+                self._clear(ip, jail_name, kind)
+            self._jail_ips[(jail_name, kind)] = new_ips
+
+    def _entry(self, ip, jail_name):
+        jails = self._ips.get(ip)
+        if jails is None:
+            jails = self._ips[ip] = {}
+            for prefix in ip_prefixes(ip):
+                self._prefixes.setdefault(prefix, set()).add(ip)
+
+        entry = jails.get(jail_name)
+        if entry is None:
+            entry = jails[jail_name] = {'updated': None}
+            for fields in KIND_FIELDS.values():
+                entry.update(fields)
+            if len(jails) > 1:
+                self._multi_service.add(ip)
+        return entry
+
+    def _clear(self, ip, jail_name, kind):
+        jails = self._ips.get(ip)
+        entry = jails and jails.get(jail_name)
+        if not entry:
+            return
+        entry.update(KIND_FIELDS[kind])
+        if entry['banned'] or entry['fail_count'] is not None or entry['log_hits'] is not None:
+            return
+
+        del jails[jail_name]
+        if len(jails) < 2:
+            self._multi_service.discard(ip)
+        if not jails:
+            del self._ips[ip]
+            for prefix in ip_prefixes(ip):
+                ips = self._prefixes.get(prefix)
+                if ips is not None:
+                    ips.discard(ip)
+                    if not ips:
+                        del self._prefixes[prefix]
+
+    def _record(self, ip):
+        jails = self._ips[ip]
+        return {
+            'ip': ip,
+            'jails': [dict(entry, jail=jail) for jail, entry in sorted(jails.items())],
+            'banned_in': sorted(jail for jail, entry in jails.items() if entry['banned']),
+            'failing_in': sorted(jail for jail, entry in jails.items() if entry['fail_count'] is not None),
+            'multi_service': ip in self._multi_service
+        }
+
+    def lookup(self, ip):
+        """Everything known about one IP, or None"""
+        with self._lock:
+            if ip not in self._ips:
+                return None
+            return self._record(ip)
+
+    def lookup_prefix(self, prefix, limit=500):
+        """Records for the IPs in an indexed /24 or /16 network"""
+        with self._lock:
+            ips = sorted(self._prefixes.get(prefix, ()))
+            return [self._record(ip) for ip in ips[:limit]], len(ips)
+
+    def multi_service(self, limit=500):
+        """Records for IPs seen in more than one jail"""
+        with self._lock:
+            ips = sorted(self._multi_service)
+            return [self._record(ip) for ip in ips[:limit]], len(ips)
+
+    def stats(self):
+        """Size of the index"""
+        with self._lock:
+            return {
+                'ips': len(self._ips),
+                'prefixes': len(self._prefixes),
+                'multi_service': len(self._multi_service)
+            }
@@ -3,11 +3,13 @@
 Log Parser - Parse various log files for malicious activity
 Supports: sshd, postfix-sasl, nginx, apache
 """
-import subprocess
 import re
 from datetime import datetime
 from collections import defaultdict
 
+from profiling import span
+from resilience import get_breaker, run_backend_command
+
 
 class LogParser:
     """Parser for various log files to extract malicious IP activity"""
@@ -58,10 +60,37 @@ class LogParser:
         ],
     }
 
-    def __init__(self):
+    def __init__(self, helper=None):
         self.cache = {}
+        # Optional HelperClient; without it logs are read with sudo
+        self.helper = helper
+
+    def _log_exists(self, path, deadline=None):
+        """Check a log file exists, through that file's breaker"""
+        breaker = get_breaker(f'log:{path}')
+        if self.helper:
+            return breaker.call(self.helper.stat, path, deadline)['exists']
+
+        _, returncode = breaker.call(
+            run_backend_command, ['sudo', 'test', '-f', path], deadline, 5
+        )
+        return returncode == 0
+
+    def _tail_log(self, path, lines, deadline=None):
+        """Last lines of a log file as text, or None if it cannot be read"""
+        breaker = get_breaker(f'log:{path}')
+        if self.helper:
+            try:
+                return breaker.call(self.helper.tail_log, path, lines, deadline)
+            except FileNotFoundError:
+                return None
 
-    def _find_log_file(self, jail_name):
+        output, returncode = breaker.call(
+            run_backend_command, ['sudo', 'tail', '-n', str(lines), path], deadline
+        )
+        return output if returncode == 0 else None
+
+    def _find_log_file(self, jail_name, deadline=None):
         """Find the appropriate log file for a jail"""
         # Map jail name to log type
         log_type = None
@@ -75,16 +104,8 @@ class LogParser:
 
         # Find existing log file
         for path in self.LOG_PATHS.get(log_type, []):
-            try:
-                result = subprocess.run(
-                    ['sudo', 'test', '-f', path],
-                    capture_output=True,
-                    timeout=5
-                )
-                if result.returncode == 0:
-                    return path, log_type
-            except Exception:
-                continue
+            if self._log_exists(path, deadline):
+                return path, log_type
 
         return None, log_type
 
@@ -95,9 +116,9 @@ class LogParser:
                 return self.PATTERNS[key]
         return self.PATTERNS.get('sshd', [])
 
-    def parse_logs(self, jail_name, limit=100):
+    def parse_logs(self, jail_name, limit=100, deadline=None):
         """Parse logs and extract malicious IP activity"""
-        log_file, log_type = self._find_log_file(jail_name)
+        log_file, log_type = self._find_log_file(jail_name, deadline)
 
         if not log_file:
             return []
@@ -106,30 +127,26 @@ class LogParser:
         if not patterns:
             return []
 
-        try:
-            # Read last N lines of log file
-            result = subprocess.run(
-                ['sudo', 'tail', '-n', '10000', log_file],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
+        # Read last N lines of log file
+        output = self._tail_log(log_file, 10000, deadline)
 
-            if result.returncode != 0:
-                return []
+        if output is None:
+            return []
 
+        try:
             ip_data = defaultdict(lambda: {'count': 0, 'last_seen': None, 'lines': []})
 
-            for line in result.stdout.split('\n'):
-                for pattern in patterns:
-                    match = re.search(pattern, line)
-                    if match:
-                        ip = match.group(1)
-                        ip_data[ip]['count'] += 1
-                        ip_data[ip]['last_seen'] = self._extract_timestamp(line)
-                        if len(ip_data[ip]['lines']) < 3:  # Keep only last 3 log lines
-                            ip_data[ip]['lines'].append(line[:200])  # Truncate long lines
-                        break
+            with span(f'regex parse_logs {log_file}'):
+                for line in output.split('\n'):
+                    for pattern in patterns:
+                        match = re.search(pattern, line)
+                        if match:
+                            ip = match.group(1)
+                            ip_data[ip]['count'] += 1
+                            ip_data[ip]['last_seen'] = self._extract_timestamp(line)
+                            if len(ip_data[ip]['lines']) < 3:  # Keep only last 3 log lines
+                                ip_data[ip]['lines'].append(line[:200])  # Truncate long lines
+                            break
 
             # Convert to list and sort by count
             logs = []
@@ -144,9 +161,7 @@ class LogParser:
             logs.sort(key=lambda x: x['count'], reverse=True)
             return logs[:limit]
 
-        except subprocess.TimeoutExpired:
-            return []
-        except Exception as e:
+        except Exception:
             return []
 
     def _extract_timestamp(self, line):
@@ -166,9 +181,9 @@ class LogParser:
 
         return None
 
-    def get_attack_summary(self, jail_name):
+    def get_attack_summary(self, jail_name, deadline=None):
         """Get summary of attacks for a jail"""
-        logs = self.parse_logs(jail_name)
+        logs = self.parse_logs(jail_name, deadline=deadline)
 
         if not logs:
             return {
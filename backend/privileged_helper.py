@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Privileged Helper - Read-only access to logs and firewall counters
+Runs as root and serves a fixed allowlist of read operations over a Unix
+socket, so the dashboard does not fork `sudo` for every refresh.
+
+Protocol (one connection can carry many requests):
+  request:  one JSON line, e.g. {"op": "tail_log", "path": "...", "lines": 100}
+  response: one JSON header line ({"ok": true, ...} or {"ok": false, "error": ...})
+            followed, if ok, by frames of 4-byte big-endian length + data,
+            ending with a zero-length frame
+
+Usage:
+  sudo python privileged_helper.py --socket /run/fail2ban-dashboard/helper.sock \
+      --group fail2ban-dash
+"""
+import argparse
+import grp
+import json
+import os
+import pwd
+import socket
+import socketserver
+import struct
+import subprocess
+
+from fail2ban_service import FAIL2BAN_LOG
+from log_parser import LogParser
+
+DEFAULT_SOCKET = '/run/fail2ban-dashboard/helper.sock'
+CHUNK_SIZE = 64 * 1024
+MAX_REQUEST = 4096
+MAX_TAIL_LINES = 100000
+
+# Only these files can be read or stat'ed through the helper
+ALLOWED_LOGS = frozenset(
+    [FAIL2BAN_LOG] + [path for paths in LogParser.LOG_PATHS.values() for path in paths]
+)
+
+
+class HelperRequestError(Exception):
+    """Request that is invalid, disallowed or cannot be served"""
+
+
+def _allowed_path(request):
+    path = request.get('path')
+    if path not in ALLOWED_LOGS:
+        raise HelperRequestError(f'Path not allowed: {path}')
+    return path
+
+
+def _int_param(request, name, default, minimum=0, maximum=None):
+    try:
+        value = int(request.get(name, default))
+    except (TypeError, ValueError):
+        raise HelperRequestError(f'Invalid {name}')
+    if value < minimum or (maximum is not None and value > maximum):
+        raise HelperRequestError(f'{name} out of range')
+    return value
+
+
+def _read_range(f, start, end):
+    """Yield the bytes of f between start and end, then close it"""
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _tail_offset(f, size, lines):
+    """Offset where the last `lines` lines of f start"""
+    end = size
+    if size:
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            end = size - 1
+
+    pos = end
+    found = 0
+    while pos > 0:
+        read_size = min(CHUNK_SIZE, pos)
+        pos -= read_size
+        f.seek(pos)
+        data = f.read(read_size)
+        idx = len(data)
+        while True:
+            idx = data.rfind(b'\n', 0, idx)
+            if idx < 0:
+                break
+            found += 1
+            if found == lines:
+                return pos + idx + 1
+    return 0
+
+
+def op_stat(request):
+    """Stat an allowed log file"""
+    path = _allowed_path(request)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {'ok': True, 'exists': False}, []
+    return {
+        'ok': True,
+        'exists': True,
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'inode': st.st_ino
+    }, []
+
+
+def op_read_log(request):
+    """Read an allowed log file from an offset
+
+    An offset past the end of the file means it was rotated or truncated,
+    so reading restarts from the beginning.
+    """
+    path = _allowed_path(request)
+    offset = _int_param(request, 'offset', 0)
+    length = _int_param(request, 'length', 0) if request.get('length') is not None else None
+
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if offset > size:
+        offset = 0
+    end = size if length is None else min(size, offset + length)
+    return {'ok': True, 'offset': offset, 'end': end, 'size': size}, _read_range(f, offset, end)
+
+
+def op_tail_log(request):
+    """Read the last N lines of an allowed log file"""
+    path = _allowed_path(request)
+    lines = _int_param(request, 'lines', 1000, minimum=1, maximum=MAX_TAIL_LINES)
+
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        offset = _tail_offset(f, size, lines)
+    except OSError:
+        f.close()
+        raise
+    return {'ok': True, 'offset': offset, 'end': size, 'size': size}, _read_range(f, offset, size)
+
+
+def op_iptables_counters(request):
+    """Dump firewall rules with packet counters (iptables-save -c)"""
+    try:
+        result = subprocess.run(
+            ['iptables-save', '-c'],
+            capture_output=True,
+            timeout=30
+        )
+    except OSError as e:
+        # Not a missing log file: report it without an errno
+        raise HelperRequestError(f'iptables-save failed: {e}')
+    output = result.stdout
+    chunks = (output[i:i + CHUNK_SIZE] for i in range(0, len(output), CHUNK_SIZE))
+    return {'ok': True, 'returncode': result.returncode}, chunks
+
+
+OPERATIONS = {
+    'stat': op_stat,
+    'read_log': op_read_log,
+    'tail_log': op_tail_log,
+    'iptables_counters': op_iptables_counters,
+}
+
+
+class HelperHandler(socketserver.StreamRequestHandler):
+    """Serve requests on one client connection until it closes"""
+
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            return
+
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST:
+                self._send_header({'ok': False, 'error': 'Request too large'})
+                return
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or request.get('op') not in OPERATIONS:
+                    raise HelperRequestError('Unknown operation')
+                header, body = OPERATIONS[request['op']](request)
+            except (HelperRequestError, ValueError) as e:
+                self._send_header({'ok': False, 'error': str(e)})
+                continue
+            except OSError as e:
+                self._send_header({'ok': False, 'error': str(e), 'errno': e.errno})
+                continue
+            except subprocess.TimeoutExpired:
+                self._send_header({'ok': False, 'error': 'Command timed out'})
+                continue
+
+            try:
+                self._send_header(header)
+                for chunk in body:
+                    self.wfile.write(struct.pack('>I', len(chunk)) + chunk)
+                self.wfile.write(struct.pack('>I', 0))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # Client stopped reading part way through
+                return
+
+    def _send_header(self, header):
+        self.wfile.write(json.dumps(header).encode() + b'\n')
+        self.wfile.flush()
+
+
+class HelperServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server that only talks to allowed local users"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, allowed_uids=None):
+        self.allowed_uids = allowed_uids
+        super().__init__(socket_path, HelperHandler)
+
+    def peer_allowed(self, sock):
+        """Check the connecting process's uid (Linux SO_PEERCRED)"""
+        if not self.allowed_uids:
+            return True
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == 0 or uid in self.allowed_uids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail2ban Dashboard privileged helper')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket path')
+    parser.add_argument('--group', help='Group allowed to connect to the socket')
+    parser.add_argument('--user', action='append', default=[],
+                        help='User allowed to connect (repeatable, default: any member of --group)')
+    args = parser.parse_args()
+
+    socket_dir = os.path.dirname(args.socket)
+    created_dir = not os.path.isdir(socket_dir)
+    os.makedirs(socket_dir, mode=0o750, exist_ok=True)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    allowed_uids = {pwd.getpwnam(name).pw_uid for name in args.user}
+
+    # Only root and the dashboard group can reach the socket; the umask
+    # keeps it closed between bind() and chmod()
+    old_umask = os.umask(0o117)
+    try:
+        server = HelperServer(args.socket, allowed_uids)
+    finally:
+        os.umask(old_umask)
+    os.chmod(args.socket, 0o660)
+    if args.group:
+        gid = grp.getgrnam(args.group).gr_gid
+        if created_dir:
+            os.chown(socket_dir, 0, gid)
+        os.chown(args.socket, 0, gid)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
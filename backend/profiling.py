@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Profiling - Per-request span tracing, slow-request log and cProfile summaries
+Services wrap expensive steps (subprocesses, regex passes, GeoIP calls,
+JSON serialization) in span(); the spans of the current request are
+collected into its Trace. Outside a traced request span() does nothing.
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import time
+from collections import deque
+
+MAX_SPANS = 500
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """Timing breakdown of one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []
+        self.dropped = 0
+        self._t0 = time.perf_counter()
+        self._depth = 0
+
+    def elapsed(self):
+        """Seconds since the trace started"""
+        return time.perf_counter() - self._t0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'spans': self.spans,
+            'dropped_spans': self.dropped
+        }
+
+
+class _Span:
+    """Context manager timing one step of the current request"""
+
+    __slots__ = ('name', 'trace', 'start', 'depth')
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = _current_trace.get()
+
+    def __enter__(self):
+        trace = self.trace
+        if trace is not None:
+            self.start = trace.elapsed()
+            self.depth = trace._depth
+            trace._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if trace is None:
+            return False
+        trace._depth -= 1
+        if len(trace.spans) >= MAX_SPANS:
+            trace.dropped += 1
+            return False
+        trace.spans.append({
+            'name': self.name,
+            'start_ms': round(self.start * 1000, 1),
+            'duration_ms': round((trace.elapsed() - self.start) * 1000, 1),
+            'depth': self.depth,
+            'error': exc_type.__name__ if exc_type else None
+        })
+        return False
+
+
+def span(name):
+    """Time one step of the current request: `with span('geoip'): ...`"""
+    return _Span(name)
+
+
+def start_trace(name):
+    """Start tracing the current request; returns a token for finish_trace"""
+    return _current_trace.set(Trace(name))
+
+
+def finish_trace(token):
+    """Stop tracing and return the finished Trace"""
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    trace.duration = trace.elapsed()
+    # Spans are appended as they finish; show them in start order
+    trace.spans.sort(key=lambda s: (s['start_ms'], s['depth']))
+    return trace
+
+
+class SlowRequestLog:
+    """Bounded in-memory ring buffer of slow request traces"""
+
+    def __init__(self, threshold, size=100):
+        self.threshold = threshold
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, trace, status_code):
+        """Keep the trace if the request took at least the threshold"""
+        if trace.duration < self.threshold:
+            return False
+        entry = dict(trace.to_dict(), status=status_code)
+        with self._lock:
+            self._entries.append(entry)
+        return True
+
+    def entries(self):
+        """Recorded traces, newest first"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+# Only one profiler can be active at a time. On Python 3.12+ it sees every
+# thread, so a summary can include other requests running at the same time
+profiler_lock = threading.Lock()
+
+
+def start_profiler():
+    """Start a cProfile profiler, or return None if one is already running"""
+    if not profiler_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler):
+    """Stop a profiler started by start_profiler"""
+    profiler.disable()
+    profiler_lock.release()
+
+
+def format_report(trace, profiler=None, limit=30):
+    """Plain-text span breakdown, plus a cProfile summary if profiled"""
+    out = io.StringIO()
+    out.write(f'{trace.name}  {trace.duration * 1000:.1f} ms\n\n')
+    out.write('Spans (start, duration):\n')
+    for s in trace.spans:
+        indent = '  ' * s['depth']
+        error = f"  [{s['error']}]" if s['error'] else ''
+        out.write(f"{s['start_ms']:>9.1f} ms {s['duration_ms']:>9.1f} ms  {indent}{s['name']}{error}\n")
+    if trace.dropped:
+        out.write(f'({trace.dropped} more spans not recorded)\n')
+
+    if profiler is not None:
+        out.write(f'\ncProfile (top {limit} by cumulative time):\n')
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Resilience - Request deadlines, circuit breakers and last-good-data cache
+Keeps a stuck backend (fail2ban, iptables, log files, GeoIP) from tying up
+a worker for the full length of every chained subprocess timeout.
+"""
+import subprocess
+import threading
+import time
+
+from profiling import span
+
+# Upper bound for a single subprocess; a request deadline may shorten it
+COMMAND_TIMEOUT = 30
+
+# A backend call given at least this long (or its whole cap, if shorter)
+# had a fair chance to answer, so timing out counts against its breaker
+MIN_FAIR_TIMEOUT = 2.0
+
+
+class BackendUnavailable(Exception):
+    """A backend call failed, timed out or was rejected by its breaker"""
+
+
+class DeadlineExceeded(BackendUnavailable):
+    """The request ran out of time; says nothing about the backend's health"""
+
+
+def run_backend_command(cmd, deadline=None, cap=COMMAND_TIMEOUT, check=None):
+    """Run a command, raising BackendUnavailable if it hangs or cannot start
+
+    Returns (stdout, returncode). A non-zero return code is an answer from
+    the backend, not a failure of it, so it is left to the caller.
+
+    A timeout counts against the backend (see timeout_error) unless the
+    request deadline was nearly spent before the command started.
+
+    check, if given, is called with the CompletedProcess and returns an
+    error message when the output shows the backend itself is down (for
+    example a client that cannot reach its server); that is raised as
+    BackendUnavailable.
+    """
+    name = cmd[1] if cmd[0] == 'sudo' else cmd[0]
+    timeout = deadline.timeout(cap) if deadline else cap
+    try:
+        with span('subprocess ' + ' '.join(cmd[1:] if cmd[0] == 'sudo' else cmd)):
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=timeout
+            )
+    except subprocess.TimeoutExpired:
+        raise timeout_error(name, timeout, cap)
+    except OSError as e:
+        raise BackendUnavailable(f'{name} failed: {e}')
+
+    error = check(result) if check else None
+    if error:
+        raise BackendUnavailable(f'{name}: {error}')
+    return result.stdout, result.returncode
+
+
+def timeout_error(name, timeout, cap):
+    """Error for a backend call that timed out after `timeout` seconds
+
+    A call that had a fair slice of time (MIN_FAIR_TIMEOUT, or its whole
+    cap) and still timed out points at a hung backend: BackendUnavailable,
+    which the breaker counts. Only a call squeezed by an almost spent
+    request deadline gets DeadlineExceeded, which it does not.
+    """
+    if timeout < min(cap, MIN_FAIR_TIMEOUT):
+        return DeadlineExceeded(f'{name} ran out of request time after {timeout:.1f}s')
+    return BackendUnavailable(f'{name} timed out after {timeout:.1f}s')
+
+
+class Deadline:
+    """Time budget for a single request, shared across its backend calls"""
+
+    def __init__(self, budget):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        """Seconds left before the deadline (never negative)"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """Whether the budget has been used up"""
+        return self.remaining() <= 0
+
+    def split(self, parts):
+        """Child deadline getting an even share of the remaining budget
+
+        Time not used by one part rolls over to the parts split after it.
+        """
+        return Deadline(self.remaining() / max(1, parts))
+
+    def timeout(self, cap):
+        """Timeout for one backend call: the remaining budget, at most cap"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('Request deadline exceeded')
+        return min(cap, remaining)
+
+
+class CircuitBreaker:
+    """Fail fast while a backend is unhealthy
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    rejects calls for `reset_timeout` seconds. It then lets a single trial
+    call through (half-open); success closes it again, failure re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half-open'"""
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn through the breaker
+
+        fn signals a backend failure by raising BackendUnavailable.
+        DeadlineExceeded is the caller running out of time, not the
+        backend failing, so it does not count against the breaker.
+        """
+        self._acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except DeadlineExceeded:
+            self._release()
+            raise
+        except BackendUnavailable:
+            self._record_failure()
+            raise
+        except Exception:
+            self._release()
+            raise
+        self._record_success()
+        return result
+
+    def _acquire(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            cooling = time.monotonic() - self.opened_at < self.reset_timeout
+            if cooling or self._trial:
+                raise BackendUnavailable(f'{self.name} is unavailable (circuit open)')
+            self._trial = True
+
+    def _release(self):
+        with self._lock:
+            self._trial = False
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    def _record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Get the shared circuit breaker for a backend, creating it if needed"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def breaker_states():
+    """Current state of every known backend breaker"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.state for b in breakers}
+
+
+class StaleCache:
+    """Last good result per key, served while its backend is unhealthy"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        """Remember a fresh result"""
+        with self._lock:
+            self._data[key] = (value, time.time())
+
+    def get(self, key):
+        """Return (value, age in seconds) or None if nothing was cached"""
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        return value, time.time() - stored_at